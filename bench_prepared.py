@@ -0,0 +1,78 @@
+"""Micro-benchmark for the prepared statements in database.py.
+
+Times every hot statement sent as plain SQL and through its prepared
+EXECUTE, against the database configured in .env (point it at a local
+Postgres, not production):
+
+    python bench_prepared.py --iterations 5000
+"""
+import argparse
+import re
+import statistics
+import time
+
+import database
+
+BENCH_USER_ID = -1  # scratch row, deleted afterwards
+BENCH_USERNAME = "bench_user"
+
+# statement name -> parameters
+CASES = {
+    "get_user": (BENCH_USER_ID,),
+    "add_user": (BENCH_USER_ID, BENCH_USERNAME),
+    "is_user_muted": (BENCH_USER_ID,),
+    "find_user_id_by_username": (BENCH_USERNAME,),
+    "update_coins": (0, BENCH_USER_ID),
+    "get_cooldown_days": (BENCH_USER_ID,),
+    "get_gamble_bank": (),
+    "get_send_streak": (BENCH_USER_ID, BENCH_USER_ID),
+}
+
+
+def plain_sql(sql):
+    # Placeholders in PREPARED_STATEMENTS are numbered in the order they appear
+    return re.sub(r"\$\d+", "%s", sql)
+
+
+def measure(cur, sql, params, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        cur.execute(sql, params)
+        if cur.description:
+            cur.fetchall()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare plain and prepared latency of the hot queries.")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=200)
+    args = parser.parse_args()
+
+    cur = database.get_cursor()
+    database.add_user(BENCH_USER_ID, BENCH_USERNAME)
+
+    print(f"{'statement':<28}{'plain p50':>12}{'prepared p50':>14}{'plain p99':>12}{'prepared p99':>14}{'speedup':>9}")
+    try:
+        for name, params in CASES.items():
+            plain = plain_sql(database.PREPARED_STATEMENTS[name])
+            prepared = database.EXECUTE_SQL[name]
+            measure(cur, plain, params, args.warmup)
+            measure(cur, prepared, params, args.warmup)
+            plain_times = measure(cur, plain, params, args.iterations)
+            prepared_times = measure(cur, prepared, params, args.iterations)
+
+            plain_p50 = statistics.median(plain_times) * 1e6
+            prepared_p50 = statistics.median(prepared_times) * 1e6
+            plain_p99 = statistics.quantiles(plain_times, n=100)[98] * 1e6
+            prepared_p99 = statistics.quantiles(prepared_times, n=100)[98] * 1e6
+            print(f"{name:<28}{plain_p50:>10.1f}µs{prepared_p50:>12.1f}µs{plain_p99:>10.1f}µs{prepared_p99:>12.1f}µs"
+                  f"{plain_p50 / prepared_p50:>8.2f}x")
+    finally:
+        cur.execute("DELETE FROM users WHERE user_id = %s", (BENCH_USER_ID,))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Once-per-day cooldowns for daily claims, quests and gambles.
+
+Cooldowns are stored as UTC day numbers (days since the epoch) in the users
+table. Consuming one is a single conditional upsert, and every action known
+to be used today is cached in memory so repeated checks skip the database.
+"""
+import time
+
+import database
+
+# Where cooldowns are stored: database, or engine in ECONOMY_ENGINE=memory mode
+store = database
+
+CLAIM = "claim"
+QUEST = "quest"
+GAMBLE = "gamble"
+
+_BITS = {CLAIM: 1, QUEST: 2, GAMBLE: 4}
+
+# user_id -> bitmask of actions already used on _cache_day
+_used = {}
+_cache_day = None
+
+
+def today() -> int:
+    return int(time.time()) // 86400
+
+
+def _used_today(day: int) -> dict:
+    global _cache_day
+    if _cache_day != day:
+        _used.clear()
+        _cache_day = day
+    return _used
+
+
+def check_and_consume(user_id: int, action: str) -> bool:
+    """Use `action` for today. Returns False if the user already used it."""
+    day = today()
+    used = _used_today(day)
+    bit = _BITS[action]
+    if used.get(user_id, 0) & bit:
+        return False
+
+    consumed = store.consume_cooldown(user_id, action, day)
+    # Either way the action is now used for today
+    used[user_id] = used.get(user_id, 0) | bit
+    return consumed
+
+
+def is_used(user_id: int, action: str) -> bool:
+    """Check whether `action` was already used today without consuming it."""
+    day = today()
+    used = _used_today(day)
+    bit = _BITS[action]
+    if used.get(user_id, 0) & bit:
+        return True
+
+    mask = 0
+    for name, day_used in store.get_cooldown_days(user_id).items():
+        if day_used == day:
+            mask |= _BITS[name]
+    if mask:
+        used[user_id] = used.get(user_id, 0) | mask
+    return bool(mask & bit)
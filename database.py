@@ -1,9 +1,18 @@
 import psycopg2
 from dotenv import load_dotenv
+import contextvars
+import logging
 import os
+import re
+import time
 from datetime import datetime, timezone, timedelta
+import psycopg2.errors
 import psycopg2.extras
 
+from models import User, PendingRequest
+
+logger = logging.getLogger(__name__)
+
 # Load environment variables from .env
 load_dotenv()
 
@@ -14,22 +23,21 @@ DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
 
-# Connect to the database
-try:
-    connection = psycopg2.connect(
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME
-    )
-    connection.autocommit = True
-    print("✅ PostgreSQL connection successful!")
+# Optional read replica for staleness-tolerant reads (leaderboard, lookups, stats)
+DB_REPLICA_DSN = os.getenv("DB_REPLICA_DSN")
+# Reads go back to the primary while the replica is further behind than this (seconds)
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", 5))
+REPLICA_LAG_CHECK_INTERVAL = 5
+REPLICA_RETRY_INTERVAL = 30
 
-    cursor = connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+# === CONNECTION ===
 
+connection = None
+cursor = None
+
+def create_tables(cur):
     # Users table
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
         user_id BIGINT PRIMARY KEY,
         username TEXT,
@@ -41,8 +49,26 @@ try:
     )
     """)
 
+    # Cooldowns are stored as UTC day numbers (days since the epoch)
+    cur.execute("""
+    ALTER TABLE users
+        ADD COLUMN IF NOT EXISTS claim_day INTEGER DEFAULT NULL,
+        ADD COLUMN IF NOT EXISTS quest_day INTEGER DEFAULT NULL,
+        ADD COLUMN IF NOT EXISTS gamble_day INTEGER DEFAULT NULL
+    """)
+    # Carry over cooldowns recorded before the day columns existed
+    cur.execute("""
+    UPDATE users SET
+        claim_day = COALESCE(claim_day, FLOOR(EXTRACT(EPOCH FROM last_claim) / 86400)::INTEGER),
+        quest_day = COALESCE(quest_day, FLOOR(EXTRACT(EPOCH FROM last_quest) / 86400)::INTEGER),
+        gamble_day = COALESCE(gamble_day, FLOOR(EXTRACT(EPOCH FROM last_gamble) / 86400)::INTEGER)
+    WHERE (claim_day IS NULL AND last_claim IS NOT NULL)
+       OR (quest_day IS NULL AND last_quest IS NOT NULL)
+       OR (gamble_day IS NULL AND last_gamble IS NOT NULL)
+    """)
+
     # Transactions table
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS transactions (
         id SERIAL PRIMARY KEY,
         user_id BIGINT,
@@ -54,7 +80,7 @@ try:
     """)
 
     # Pending Requests table
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS pending_requests (
         request_id TEXT PRIMARY KEY,
         from_id BIGINT NOT NULL,
@@ -68,7 +94,7 @@ try:
     """)
     
     # Pending Gambles table
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS pending_gambles (
         id TEXT PRIMARY KEY,
         user_id BIGINT NOT NULL,
@@ -78,17 +104,17 @@ try:
     """)
     
     # Gamble Bank
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS gamble_bank (
         id BOOLEAN PRIMARY KEY DEFAULT TRUE,
         bank INTEGER DEFAULT 0
     )
     """)
     # Ensure at least one row exists
-    cursor.execute("INSERT INTO gamble_bank (id, bank) VALUES (TRUE, 0) ON CONFLICT (id) DO NOTHING")
+    cur.execute("INSERT INTO gamble_bank (id, bank) VALUES (TRUE, 0) ON CONFLICT (id) DO NOTHING")
 
     # Send Streaks table
-    cursor.execute("""
+    cur.execute("""
     CREATE TABLE IF NOT EXISTS send_streaks (
         from_user_id BIGINT NOT NULL,
         to_user_id BIGINT NOT NULL,
@@ -98,171 +124,521 @@ try:
     )
     """)
 
-    # === FUNCTIONS ===
+    # Snapshots of the in-memory engine (engine.py): balances in users.coins
+    # include every ledger row up to last_transaction_id. Final snapshots are
+    # taken when the engine stops or hands users.coins back to other writers
+    # (database mode, economy_cli.py)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS engine_snapshots (
+        id SERIAL PRIMARY KEY,
+        taken_at TIMESTAMP WITH TIME ZONE NOT NULL,
+        last_transaction_id INTEGER NOT NULL,
+        final BOOLEAN NOT NULL DEFAULT FALSE
+    )
+    """)
 
-    def log_transaction(user_id: int, tx_type: str, amount: int, target_user_id: int = None):
-        timestamp = datetime.now(timezone.utc)
-        cursor.execute("""
+# === PREPARED STATEMENTS ===
+
+# action -> (day number column, timestamp column)
+COOLDOWN_COLUMNS = {
+    "claim": ("claim_day", "last_claim"),
+    "quest": ("quest_day", "last_quest"),
+    "gamble": ("gamble_day", "last_gamble"),
+}
+
+# Hot statements, prepared once per connection so Postgres doesn't parse and
+# plan them on every call. Named after the function that runs them.
+PREPARED_STATEMENTS = {
+    "log_transaction": """
+        INSERT INTO transactions (user_id, type, amount, timestamp, target_user_id)
+        VALUES ($1, $2, $3, $4, $5)
+    """,
+    "add_user": """
+        INSERT INTO users (user_id, username)
+        VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username
+    """,
+    "add_user_id": """
+        INSERT INTO users (user_id)
+        VALUES ($1)
+        ON CONFLICT (user_id) DO NOTHING
+    """,
+    "get_user": "SELECT user_id, username, coins, is_muted_until FROM users WHERE user_id = $1",
+    "update_coins": "UPDATE users SET coins = coins + $1 WHERE user_id = $2",
+    "find_user_id_by_username": "SELECT user_id FROM users WHERE LOWER(username) = LOWER($1::TEXT)",
+    "is_user_muted": "SELECT is_muted_until FROM users WHERE user_id = $1",
+    "get_cooldown_days": "SELECT claim_day, quest_day, gamble_day FROM users WHERE user_id = $1",
+    "get_gamble_bank": "SELECT bank FROM gamble_bank WHERE id = TRUE",
+    "get_send_streak": """
+        SELECT streak_count FROM send_streaks
+        WHERE from_user_id = $1 AND to_user_id = $2
+    """,
+    "get_top_users": "SELECT user_id, coins FROM users ORDER BY coins DESC LIMIT $1",
+    "replica_lag": """
+        SELECT COALESCE(CASE
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END, 0) AS lag
+    """,
+}
+
+# Statements that may be served by the replica
+READ_STATEMENTS = {
+    "find_user_id_by_username",
+    "is_user_muted",
+    "get_cooldown_days",
+    "get_gamble_bank",
+    "get_send_streak",
+    "get_top_users",
+    "replica_lag",
+}
+PREPARED_STATEMENTS.update({
+    f"consume_{action}_cooldown": f"""
+        INSERT INTO users (user_id, {day_column}, {time_column})
+        VALUES ($1, $2, now())
+        ON CONFLICT (user_id) DO UPDATE
+            SET {day_column} = EXCLUDED.{day_column}, {time_column} = EXCLUDED.{time_column}
+            WHERE users.{day_column} IS DISTINCT FROM EXCLUDED.{day_column}
+        RETURNING user_id
+    """
+    for action, (day_column, time_column) in COOLDOWN_COLUMNS.items()
+})
+
+def _execute_sql(name, sql):
+    params = len(set(re.findall(r"\$(\d+)", sql)))
+    return f"EXECUTE {name} ({', '.join(['%s'] * params)})" if params else f"EXECUTE {name}"
+
+EXECUTE_SQL = {name: _execute_sql(name, sql) for name, sql in PREPARED_STATEMENTS.items()}
+
+def prepare_statements(cur, names=PREPARED_STATEMENTS):
+    for name in names:
+        cur.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+
+def connect():
+    """Open the connection and register the prepared statements on it."""
+    global connection, cursor
+    connection = psycopg2.connect(
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME
+    )
+    connection.autocommit = True
+    cursor = connection.cursor()
+    create_tables(cursor)
+    prepare_statements(cursor)
+    return cursor
+
+def get_cursor():
+    """Return the cursor, reconnecting first if the connection was lost."""
+    if connection is None or connection.closed:
+        connect()
+    return cursor
+
+# Set to a list (by profiling.slow_update_middleware) to collect (statement, seconds)
+# for every query run in the current context
+query_log = contextvars.ContextVar("query_log", default=None)
+
+def record_query(statement, started):
+    log = query_log.get()
+    if log is not None:
+        log.append((statement, round(time.perf_counter() - started, 6)))
+
+def query(sql, params=None):
+    cur = get_cursor()
+    started = time.perf_counter()
+    cur.execute(sql, params)
+    record_query(" ".join(sql.split())[:120], started)
+    return cur
+
+def execute_prepared(name, params=(), cur=None):
+    cur = cur or get_cursor()
+    started = time.perf_counter()
+    try:
+        cur.execute(EXECUTE_SQL[name], params)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # The server forgot our statements (e.g. DISCARD ALL behind a pooler)
+        prepare_statements(cur, READ_STATEMENTS if cur is replica_cursor else PREPARED_STATEMENTS)
+        cur.execute(EXECUTE_SQL[name], params)
+    record_query(name, started)
+    return cur
+
+# === READ ROUTING ===
+
+replica_connection = None
+replica_cursor = None
+replica_lag = 0.0
+replica_lag_checked_at = float("-inf")
+replica_down_until = float("-inf")
+
+# key (user_id or table name) -> time of the last write, for read-your-writes
+recent_writes = {}
+
+def connect_replica():
+    global replica_connection, replica_cursor
+    replica_connection = psycopg2.connect(DB_REPLICA_DSN)
+    replica_connection.autocommit = True
+    replica_cursor = replica_connection.cursor()
+    prepare_statements(replica_cursor, READ_STATEMENTS)
+    return replica_cursor
+
+def mark_written(*keys):
+    now = time.monotonic()
+    for key in keys:
+        recent_writes[key] = now
+    if len(recent_writes) > 1000:
+        for key in [key for key, at in recent_writes.items() if now - at >= DB_REPLICA_MAX_LAG]:
+            del recent_writes[key]
+
+def get_read_cursor(keys=()):
+    """Return the replica cursor if it may serve a read about `keys`, else the primary one.
+
+    The primary is used when no replica is configured, when it is unreachable or
+    lagging, or when one of `keys` was written within the lag bound.
+    """
+    global replica_lag, replica_lag_checked_at
+    now = time.monotonic()
+    if not DB_REPLICA_DSN or now < replica_down_until:
+        return get_cursor()
+    if any(now - recent_writes.get(key, float("-inf")) < DB_REPLICA_MAX_LAG for key in keys):
+        return get_cursor()
+
+    if replica_connection is None or replica_connection.closed:
+        connect_replica()
+    if now - replica_lag_checked_at >= REPLICA_LAG_CHECK_INTERVAL:
+        replica_lag = float(execute_prepared("replica_lag", cur=replica_cursor).fetchone()[0])
+        replica_lag_checked_at = now
+    return replica_cursor if replica_lag <= DB_REPLICA_MAX_LAG else get_cursor()
+
+def execute_read(name, params=(), keys=()):
+    """Run a staleness-tolerant prepared read, falling back to the primary if the replica fails."""
+    global replica_down_until
+    try:
+        cur = get_read_cursor(keys)
+        if cur is replica_cursor:
+            return execute_prepared(name, params, cur)
+    except psycopg2.errors.SerializationFailure as e:
+        # A hot standby cancels reads that conflict with WAL replay; retry this one on the primary
+        logger.warning("Replica read %s cancelled, using primary: %s", name, e, extra={"event": "replica_conflict"})
+    except psycopg2.OperationalError as e:
+        logger.warning("Read replica unavailable, using primary: %s", e, extra={"event": "replica_down"})
+        replica_down_until = time.monotonic() + REPLICA_RETRY_INTERVAL
+    return execute_prepared(name, params)
+
+# === FUNCTIONS ===
+
+# Ledger rows collected between begin_ledger_batch() and flush_ledger()
+ledger_batch = None
+
+def log_transaction(user_id: int, tx_type: str, amount: int, target_user_id: int = None):
+    timestamp = datetime.now(timezone.utc)
+    if ledger_batch is not None:
+        ledger_batch.append((user_id, tx_type, amount, timestamp, target_user_id))
+        return
+    execute_prepared("log_transaction", (user_id, tx_type, amount, timestamp, target_user_id))
+
+def begin_ledger_batch():
+    global ledger_batch
+    if ledger_batch is None:
+        ledger_batch = []
+
+def flush_ledger():
+    global ledger_batch
+    rows, ledger_batch = ledger_batch, None
+    if not rows:
+        return
+    try:
+        # One statement, so a failure leaves none of the rows written
+        psycopg2.extras.execute_values(get_cursor(), """
             INSERT INTO transactions (user_id, type, amount, timestamp, target_user_id)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (user_id, tx_type, amount, timestamp, target_user_id))
-
-    def add_user(user_id, username=None):
+            VALUES %s
+        """, rows, page_size=len(rows))
+    except psycopg2.Error:
+        # The balance changes behind these rows are already applied; keep the
+        # rows buffered so the next flush_ledger() writes them
+        ledger_batch = rows + (ledger_batch or [])
+        raise
+
+# user_id -> last username written, so repeat add_user calls skip the database
+known_users = {}
+
+def add_user(user_id, username=None):
+    if username:
+        if known_users.get(user_id) == username:
+            return
+        execute_prepared("add_user", (user_id, username))
+        known_users[user_id] = username
+    else:
+        if user_id in known_users:
+            return
+        execute_prepared("add_user_id", (user_id,))
+        known_users[user_id] = None
+
+def add_users(users):
+    """Upsert many (user_id, username) pairs in one query."""
+    rows = {}
+    for user_id, username in users:
         if username:
-            cursor.execute("""
-                INSERT INTO users (user_id, username)
-                VALUES (%s, %s)
-                ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username
-            """, (user_id, username))
+            if known_users.get(user_id) != username:
+                rows[user_id] = username
+        elif user_id not in known_users and user_id not in rows:
+            rows[user_id] = None
+    if not rows:
+        return
+    psycopg2.extras.execute_values(get_cursor(), """
+        INSERT INTO users (user_id, username)
+        VALUES %s
+        ON CONFLICT (user_id) DO UPDATE SET username = COALESCE(EXCLUDED.username, users.username)
+    """, list(rows.items()))
+    known_users.update(rows)
+
+def get_user(user_id):
+    row = execute_prepared("get_user", (user_id,)).fetchone()
+    return User(*row) if row else None
+
+def update_coins(user_id, amount):
+    execute_prepared("update_coins", (amount, user_id))
+    mark_written(user_id)
+
+def change_coins(user_id: int, amount: int, tx_type: str, target_user_id: int = None):
+    """Apply a balance change together with its ledger row."""
+    update_coins(user_id, amount)
+    log_transaction(user_id, tx_type, amount, target_user_id)
+
+def set_coins(user_id, amount):
+    query("UPDATE users SET coins = %s WHERE user_id = %s", (amount, user_id))
+    mark_written(user_id)
+
+def get_top_users(limit=10):
+    """Return up to `limit` (user_id, coins) pairs, richest first."""
+    return execute_read("get_top_users", (limit,)).fetchall()
+
+def find_user_id_by_username(username):
+    result = execute_read("find_user_id_by_username", (username,)).fetchone()
+    if not result:
+        # The user may have just shown up and not reached the replica yet
+        result = execute_prepared("find_user_id_by_username", (username,)).fetchone()
+    return result[0] if result else None
+
+def add_pending_request(request_id: str, from_id: int, to_id: int, from_username: str, to_username: str, amount: int):
+    created_at = datetime.now(timezone.utc)
+    query("""
+        INSERT INTO pending_requests (request_id, from_id, to_id, from_username, to_username, amount, created_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    """, (request_id, from_id, to_id, from_username, to_username, amount, created_at))
+
+def get_pending_request(request_id: str):
+    row = query("SELECT from_id, to_id, from_username, to_username, amount FROM pending_requests WHERE request_id = %s", (request_id,)).fetchone()
+    return PendingRequest(*row) if row else None
+
+def delete_pending_request(request_id: str):
+    query("DELETE FROM pending_requests WHERE request_id = %s", (request_id,))
+
+def cleanup_old_requests(days: int = 1):
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    query("DELETE FROM pending_requests WHERE created_at < %s", (cutoff,))
+
+def mute_user(user_id: int, hours: int = 4):
+    until = datetime.now(timezone.utc) + timedelta(hours=hours)
+    query("UPDATE users SET is_muted_until = %s WHERE user_id = %s", (until, user_id))
+    mark_written(user_id)
+
+def is_user_muted(user_id):
+    row = execute_read("is_user_muted", (user_id,), keys=(user_id,)).fetchone()
+    if row and row[0]:
+        return row[0] > datetime.now(timezone.utc)
+    return False
+
+def is_user_bankrupt(user_id: int) -> bool:
+    row = query("SELECT coins FROM users WHERE user_id = %s", (user_id,)).fetchone()
+    return row is not None and row[0] <= 0
+
+# === COOLDOWNS ===
+
+def consume_cooldown(user_id: int, action: str, day: int) -> bool:
+    """Mark `action` as used on `day`. Returns False if it was already used that day."""
+    consumed = execute_prepared(f"consume_{action}_cooldown", (user_id, day)).fetchone() is not None
+    mark_written(user_id)
+    return consumed
+
+def get_cooldown_days(user_id: int) -> dict:
+    row = execute_read("get_cooldown_days", (user_id,), keys=(user_id,)).fetchone()
+    if not row:
+        return {}
+    # Columns are selected in COOLDOWN_COLUMNS order
+    return dict(zip(COOLDOWN_COLUMNS, row))
+
+# === GAMBLE BANK ===
+
+def get_gamble_bank(stale_ok: bool = False):
+    """Pass stale_ok=True when the value is only displayed, so the replica may serve it."""
+    if stale_ok:
+        row = execute_read("get_gamble_bank", keys=("gamble_bank",)).fetchone()
+    else:
+        row = execute_prepared("get_gamble_bank").fetchone()
+    return row[0] if row else 0
+
+def add_to_gamble_bank(amount: int):
+    query("UPDATE gamble_bank SET bank = bank + %s WHERE id = TRUE", (amount,))
+    mark_written("gamble_bank")
+
+def reset_gamble_bank():
+    query("UPDATE gamble_bank SET bank = 0 WHERE id = TRUE")
+    mark_written("gamble_bank")
+
+def get_send_streak(from_user_id: int, to_user_id: int) -> int:
+    result = execute_read("get_send_streak", (from_user_id, to_user_id), keys=(from_user_id,)).fetchone()
+    return result[0] if result else 0
+
+def update_send_streak(from_user_id: int, to_user_id: int):
+    today = datetime.now(timezone.utc).date()
+    mark_written(from_user_id)
+    result = query("""
+        SELECT last_send_date FROM send_streaks 
+        WHERE from_user_id = %s AND to_user_id = %s
+    """, (from_user_id, to_user_id)).fetchone()
+
+    if result:
+        last_send = result[0]
+        yesterday = today - timedelta(days=1)
+
+        # If last send was today, don't increase streak
+        if last_send == today:
+            return
+        # If last send was yesterday, increment streak
+        elif last_send == yesterday:
+            query("""
+                UPDATE send_streaks SET streak_count = streak_count + 1, last_send_date = %s
+                WHERE from_user_id = %s AND to_user_id = %s
+            """, (today, from_user_id, to_user_id))
+        # Otherwise, reset streak to 1
         else:
-            cursor.execute("""
-                INSERT INTO users (user_id)
-                VALUES (%s)
-                ON CONFLICT (user_id) DO NOTHING
-            """, (user_id,))
-
-    def get_user(user_id):
-        cursor.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-        row = cursor.fetchone()
-        return row if row else (0, None)
-
-    def update_coins(user_id, amount):
-        cursor.execute("UPDATE users SET coins = coins + %s WHERE user_id = %s", (amount, user_id))
-
-    def set_last_claim(user_id, date_time):
-        cursor.execute("UPDATE users SET last_claim = %s WHERE user_id = %s", (date_time, user_id))
-
-    def set_coins(user_id, amount):
-        cursor.execute("UPDATE users SET coins = %s WHERE user_id = %s", (amount, user_id))
-
-    def get_top_users(limit=10):
-        cursor.execute("SELECT user_id, coins FROM users ORDER BY coins DESC LIMIT %s", (limit,))
-        return cursor.fetchall()
-
-    def find_user_id_by_username(username):
-        cursor.execute("SELECT user_id FROM users WHERE LOWER(username) = LOWER(%s)", (username,))
-        result = cursor.fetchone()
-        return result["user_id"] if result else None
-
-    def add_pending_request(request_id: str, from_id: int, to_id: int, from_username: str, to_username: str, amount: int):
-        created_at = datetime.now(timezone.utc)
-        cursor.execute("""
-            INSERT INTO pending_requests (request_id, from_id, to_id, from_username, to_username, amount, created_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (request_id, from_id, to_id, from_username, to_username, amount, created_at))
-
-    def get_pending_request(request_id: str):
-        cursor.execute("SELECT from_id, to_id, from_username, to_username, amount FROM pending_requests WHERE request_id = %s", (request_id,))
-        row = cursor.fetchone()
-        return row if row else None
-
-    def delete_pending_request(request_id: str):
-        cursor.execute("DELETE FROM pending_requests WHERE request_id = %s", (request_id,))
-
-    def cleanup_old_requests(days: int = 1):
-        cutoff = datetime.now(timezone.utc) - timedelta(days=days)
-        cursor.execute("DELETE FROM pending_requests WHERE created_at < %s", (cutoff,))
-
-    def mute_user(user_id: int, hours: int = 4):
-        until = datetime.now(timezone.utc) + timedelta(hours=hours)
-        cursor.execute("UPDATE users SET is_muted_until = %s WHERE user_id = %s", (until, user_id))
-
-    def is_user_muted(user_id):
-        cursor.execute("""
-            SELECT is_muted_until FROM users WHERE user_id = %s
-        """, (user_id,))
-        row = cursor.fetchone()
-        if row and row["is_muted_until"]:
-            return row["is_muted_until"] > datetime.now(timezone.utc)
-        return False
-
-    def has_used_quest_today(user_id: int) -> bool:
-        today_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-        cursor.execute("SELECT last_quest FROM users WHERE user_id = %s", (user_id,))
-        row = cursor.fetchone()
-        return row and row["last_quest"] == today_str
-    
-    def has_used_gamble_today(user_id: int) -> bool:
-        today_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-        cursor.execute("SELECT last_gamble FROM users WHERE user_id = %s", (user_id,))
-        row = cursor.fetchone()
-        return row and row["last_gamble"] == today_str
-
-    def is_user_bankrupt(user_id: int) -> bool:
-        cursor.execute("SELECT coins FROM users WHERE user_id = %s", (user_id,))
-        row = cursor.fetchone()
-        return row and row["coins"] <= 0
-    
-    def update_user_quest_time(user_id: int):
-        today_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-        cursor.execute("UPDATE users SET last_quest = %s WHERE user_id = %s", (today_str, user_id))
-        
-    def update_user_gamble_time(user_id: int):
-        today_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-        cursor.execute("UPDATE users SET last_gamble = %s WHERE user_id = %s", (today_str, user_id))
-        
-    # === GAMBLE BANK ===
-
-    def get_gamble_bank():
-        cursor.execute("SELECT bank FROM gamble_bank WHERE id = TRUE")
-        row = cursor.fetchone()
-        return row["bank"] if row else 0
-
-    def add_to_gamble_bank(amount: int):
-        cursor.execute("UPDATE gamble_bank SET bank = bank + %s WHERE id = TRUE", (amount,))
-
-    def reset_gamble_bank():
-        cursor.execute("UPDATE gamble_bank SET bank = 0 WHERE id = TRUE")
-
-    def get_send_streak(from_user_id: int, to_user_id: int) -> int:
-        cursor.execute("""
-            SELECT streak_count FROM send_streaks 
-            WHERE from_user_id = %s AND to_user_id = %s
-        """, (from_user_id, to_user_id))
-        result = cursor.fetchone()
-        return result["streak_count"] if result else 0
-
-    def update_send_streak(from_user_id: int, to_user_id: int):
-        today = datetime.now(timezone.utc).date()
-        cursor.execute("""
-            SELECT last_send_date FROM send_streaks 
-            WHERE from_user_id = %s AND to_user_id = %s
-        """, (from_user_id, to_user_id))
-        result = cursor.fetchone()
-        
-        if result:
-            last_send = result["last_send_date"]
-            yesterday = today - timedelta(days=1)
-            
-            # If last send was today, don't increase streak
-            if last_send == today:
-                return
-            # If last send was yesterday, increment streak
-            elif last_send == yesterday:
-                cursor.execute("""
-                    UPDATE send_streaks SET streak_count = streak_count + 1, last_send_date = %s
-                    WHERE from_user_id = %s AND to_user_id = %s
-                """, (today, from_user_id, to_user_id))
-            # Otherwise, reset streak to 1
-            else:
-                cursor.execute("""
-                    UPDATE send_streaks SET streak_count = 1, last_send_date = %s
-                    WHERE from_user_id = %s AND to_user_id = %s
-                """, (today, from_user_id, to_user_id))
-        else:
-            # First time sending to this user
-            cursor.execute("""
-                INSERT INTO send_streaks (from_user_id, to_user_id, streak_count, last_send_date)
-                VALUES (%s, %s, 1, %s)
-            """, (from_user_id, to_user_id, today))
-
-    def reset_send_streak(from_user_id: int, to_user_id: int):
-        cursor.execute("""
-            DELETE FROM send_streaks 
-            WHERE from_user_id = %s AND to_user_id = %s
-        """, (from_user_id, to_user_id))
+            query("""
+                UPDATE send_streaks SET streak_count = 1, last_send_date = %s
+                WHERE from_user_id = %s AND to_user_id = %s
+            """, (today, from_user_id, to_user_id))
+    else:
+        # First time sending to this user
+        query("""
+            INSERT INTO send_streaks (from_user_id, to_user_id, streak_count, last_send_date)
+            VALUES (%s, %s, 1, %s)
+        """, (from_user_id, to_user_id, today))
+
+def reset_send_streak(from_user_id: int, to_user_id: int):
+    mark_written(from_user_id)
+    query("""
+        DELETE FROM send_streaks 
+        WHERE from_user_id = %s AND to_user_id = %s
+    """, (from_user_id, to_user_id))
+
+# === ENGINE HANDOFF ===
+
+def engine_owns_balances() -> bool:
+    """True while the latest engine snapshot isn't final: the in-memory engine is
+    running, or it crashed and users.coins is missing ledger rows until it recovers."""
+    row = query("SELECT final FROM engine_snapshots ORDER BY id DESC LIMIT 1").fetchone()
+    return row is not None and not row[0]
+
+# === BULK OPERATIONS ===
+
+# Exportable tables: name -> (table, columns, key columns)
+BULK_TABLES = {
+    "users": ("users", ["user_id", "username", "coins", "last_claim", "last_quest", "last_gamble",
+                        "is_muted_until", "claim_day", "quest_day", "gamble_day"], ["user_id"]),
+    "streaks": ("send_streaks", ["from_user_id", "to_user_id", "streak_count", "last_send_date"],
+                ["from_user_id", "to_user_id"]),
+    "ledger": ("transactions", ["id", "user_id", "type", "amount", "timestamp", "target_user_id"], ["id"]),
+}
+
+def export_table(name: str, file):
+    """Stream a table to `file` as CSV with a header row."""
+    table, columns, keys = BULK_TABLES[name]
+    get_cursor().copy_expert(f"""
+        COPY (SELECT {', '.join(columns)} FROM {table} ORDER BY {', '.join(keys)})
+        TO STDOUT WITH (FORMAT csv, HEADER)
+    """, file)
+
+def import_table(name: str, file) -> tuple:
+    """Load a CSV written by export_table, upserting by key. Returns (imported, skipped) row counts.
+
+    Ledger rows keep their ids. Rows identical to ones already stored are skipped,
+    so importing the same file twice is harmless; an id already used by a different
+    row aborts the import rather than losing that row."""
+    table, columns, keys = BULK_TABLES[name]
+    column_list, key_list = ", ".join(columns), ", ".join(keys)
+    if name == "ledger":
+        on_conflict = "DO NOTHING"
+    else:
+        on_conflict = "DO UPDATE SET " + ", ".join(f"{c} = EXCLUDED.{c}" for c in columns if c not in keys)
+
+    cur = get_cursor()
+    cur.execute("BEGIN")
+    try:
+        cur.execute(f"CREATE TEMP TABLE bulk_import (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+        cur.copy_expert(f"COPY bulk_import ({column_list}) FROM STDIN WITH (FORMAT csv, HEADER)", file)
+        total = cur.rowcount
+        if name == "ledger":
+            incoming = ", ".join(f"b.{c}" for c in columns if c not in keys)
+            stored = ", ".join(f"t.{c}" for c in columns if c not in keys)
+            cur.execute(f"""
+                SELECT COUNT(*) FROM bulk_import b JOIN transactions t USING (id)
+                WHERE ({incoming}) IS DISTINCT FROM ({stored})
+            """)
+            collisions = cur.fetchone()[0]
+            if collisions:
+                raise ValueError(f"{collisions} ledger row(s) reuse ids held by different rows in this database")
+        cur.execute(f"""
+            INSERT INTO {table} ({column_list})
+            SELECT DISTINCT ON ({key_list}) {column_list} FROM bulk_import
+            ON CONFLICT ({key_list}) {on_conflict}
+        """)
+        imported = cur.rowcount
+        if name == "ledger":
+            cur.execute("""
+                SELECT setval(pg_get_serial_sequence('transactions', 'id'), GREATEST(MAX(id), 1))
+                FROM transactions
+            """)
+        cur.execute("COMMIT")
+    except Exception:
+        if not cur.connection.closed:
+            cur.execute("ROLLBACK")
+        raise
+    known_users.clear()
+    return imported, total - imported
+
+def airdrop(amount: int, tx_type: str = "airdrop") -> int:
+    """Credit every user in one statement, with a matching ledger row each. Returns the number of users."""
+    return query("""
+        WITH credited AS (
+            UPDATE users SET coins = coins + %s RETURNING user_id
+        )
+        INSERT INTO transactions (user_id, type, amount, timestamp, target_user_id)
+        SELECT user_id, %s, %s, now(), NULL FROM credited
+    """, (amount, tx_type, amount)).rowcount
+
+def reset_economy(amount: int = 0) -> int:
+    """Start a new season: set every balance to `amount` and empty the gamble bank.
+
+    Each changed balance gets a season_reset ledger row for the difference.
+    Returns the number of users whose balance changed.
+    """
+    changed = query("""
+        WITH reset AS (
+            UPDATE users SET coins = %s
+            FROM users AS old
+            WHERE old.user_id = users.user_id AND users.coins IS DISTINCT FROM %s
+            RETURNING users.user_id, %s - COALESCE(old.coins, 0) AS delta
+        )
+        INSERT INTO transactions (user_id, type, amount, timestamp, target_user_id)
+        SELECT user_id, 'season_reset', delta, now(), NULL FROM reset
+    """, (amount, amount, amount)).rowcount
+    reset_gamble_bank()
+    return changed
 
+# Connect to the database
+try:
+    connect()
+    print("✅ PostgreSQL connection successful!")
 except Exception as e:
     print(f"❌ Failed to connect to PostgreSQL: {e}")
-
-
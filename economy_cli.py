@@ -0,0 +1,73 @@
+"""Bulk economy operations from the command line.
+
+Talks to the database configured in .env:
+
+    python economy_cli.py export users users.csv
+    python economy_cli.py import ledger ledger.csv
+    python economy_cli.py airdrop 100
+    python economy_cli.py reset --amount 0
+    python economy_cli.py recover
+
+Stop a bot running with ECONOMY_ENGINE=memory first (or use its admin
+commands instead); it would overwrite these changes with its own state.
+The other commands refuse to run until the engine has shut down cleanly.
+After an engine crash, `recover` replays the ledger into users.coins.
+"""
+import argparse
+
+import database
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import/export and airdrops for the economy.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="write a table as CSV")
+    export_parser.add_argument("table", choices=database.BULK_TABLES)
+    export_parser.add_argument("path")
+
+    import_parser = commands.add_parser("import", help="load a CSV written by export")
+    import_parser.add_argument("table", choices=database.BULK_TABLES)
+    import_parser.add_argument("path")
+
+    airdrop_parser = commands.add_parser("airdrop", help="give every user the same amount")
+    airdrop_parser.add_argument("amount", type=int)
+
+    reset_parser = commands.add_parser("reset", help="set every balance to the same amount and empty the gamble bank")
+    reset_parser.add_argument("--amount", type=int, default=0)
+
+    commands.add_parser("recover", help="replay the ledger after an in-memory engine crash")
+
+    args = parser.parse_args()
+
+    if args.command == "recover":
+        import engine
+        try:
+            engine.recover()
+        except RuntimeError as e:
+            raise SystemExit(f"❌ {e}")
+        print("✅ Recovered users.coins from the ledger")
+        return
+    if database.engine_owns_balances():
+        raise SystemExit("❌ The in-memory engine is running or didn't shut down cleanly. "
+                         "Stop it, or run `python economy_cli.py recover`, first.")
+
+    if args.command == "export":
+        with open(args.path, "wb") as file:
+            database.export_table(args.table, file)
+        print(f"✅ Exported {args.table} to {args.path}")
+    elif args.command == "import":
+        with open(args.path, "rb") as file:
+            try:
+                imported, skipped = database.import_table(args.table, file)
+            except ValueError as e:
+                raise SystemExit(f"❌ Import failed: {e}")
+        print(f"✅ Imported {imported} {args.table} rows ({skipped} skipped)")
+    elif args.command == "airdrop":
+        print(f"🪂 Airdropped {args.amount} coins to {database.airdrop(args.amount)} users")
+    elif args.command == "reset":
+        print(f"🍂 Reset {database.reset_economy(args.amount)} balances to {args.amount} coins")
+
+
+if __name__ == "__main__":
+    main()
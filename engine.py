@@ -0,0 +1,469 @@
+"""In-memory economy engine (ECONOMY_ENGINE=memory).
+
+Keeps the whole economy in process and mirrors the economy functions of
+database.py, so main.py can use either one. Balances live in an array
+indexed by a per-user slot. Every balance change is appended to a
+write-ahead log and flushed to the transactions table in batches. Usernames,
+mutes, cooldowns, streaks and the gamble bank are written back in the same
+flush.
+
+users.coins is only refreshed by snapshots, which also record the last
+ledger row they include (engine_snapshots). After a crash the engine loads
+the users table and replays the ledger rows after that mark. After a clean
+shutdown (a final snapshot) users.coins is complete and is loaded as is, so
+database mode and economy_cli.py can safely write in between. Between
+snapshots users.coins lags the ledger, so reconcile.py reports drift for
+recently active users. The engine must be the only writer to the economy
+tables while it runs. Until a final snapshot exists, database mode and
+economy_cli.py refuse to start (see database.engine_owns_balances); after a
+crash, recover() (economy_cli.py recover) replays the ledger and hands
+users.coins back. A running engine holds a Postgres advisory lock, so
+recover() and a second engine refuse to run alongside it.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import time
+from array import array
+from datetime import datetime, timezone, timedelta
+
+import psycopg2.extras
+
+import database
+import reconcile
+from models import User, Streak
+from database import (  # noqa: F401 -- pending requests aren't economy state and stay in Postgres
+    add_pending_request,
+    get_pending_request,
+    delete_pending_request,
+    cleanup_old_requests,
+)
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = float(os.getenv("ENGINE_FLUSH_INTERVAL", 1))
+SNAPSHOT_INTERVAL = float(os.getenv("ENGINE_SNAPSHOT_INTERVAL", 300))
+FLUSH_BATCH_SIZE = 500
+# Advisory lock key held by the running engine, so a second engine or
+# economy_cli.py recover can't mistake it for a crashed one
+ENGINE_LOCK_ID = 0x45434F4E
+
+
+class UserRecord:
+    __slots__ = ("user_id", "username", "muted_until", "claim_day", "quest_day", "gamble_day")
+
+    def __init__(self, user_id, username=None, muted_until=None, claim_day=None, quest_day=None, gamble_day=None):
+        self.user_id = user_id
+        self.username = username
+        self.muted_until = muted_until
+        self.claim_day = claim_day
+        self.quest_day = quest_day
+        self.gamble_day = gamble_day
+
+
+# === STATE ===
+
+slots = {}  # user_id -> index into records and balances
+records = []
+balances = array("q")
+usernames = {}  # lowercase username -> user_id
+streaks = {}  # (from_user_id, to_user_id) -> Streak
+gamble_bank = 0
+
+# Write-ahead log: transactions rows not yet flushed
+wal = []
+dirty_users = set()
+dirty_streaks = set()
+bank_dirty = False
+# Set when the log reaches FLUSH_BATCH_SIZE so run() flushes before its interval is up
+flush_wanted = asyncio.Event()
+# Dedicated connection holding ENGINE_LOCK_ID while the engine owns the economy
+lock_connection = None
+
+
+def _slot(user_id: int) -> int:
+    slot = slots.get(user_id)
+    if slot is None:
+        slot = len(records)
+        slots[user_id] = slot
+        records.append(UserRecord(user_id))
+        balances.append(0)
+        dirty_users.add(user_id)
+    return slot
+
+
+def _set_username(record: UserRecord, username):
+    if record.username:
+        usernames.pop(record.username.lower(), None)
+    record.username = username
+    usernames[username.lower()] = record.user_id
+    dirty_users.add(record.user_id)
+
+
+# === ECONOMY API (mirrors database.py) ===
+
+def add_user(user_id, username=None):
+    record = records[_slot(user_id)]
+    if username and record.username != username:
+        _set_username(record, username)
+
+
+def add_users(users):
+    for user_id, username in users:
+        add_user(user_id, username)
+
+
+def get_user(user_id):
+    slot = slots.get(user_id)
+    if slot is None:
+        return None
+    record = records[slot]
+    return User(record.user_id, record.username, balances[slot], record.muted_until)
+
+
+def change_coins(user_id: int, amount: int, tx_type: str, target_user_id: int = None):
+    balances[_slot(user_id)] += amount
+    wal.append((user_id, tx_type, amount, datetime.now(timezone.utc), target_user_id))
+    if len(wal) >= FLUSH_BATCH_SIZE:
+        # Never flush inline: the balance has already changed, so a database
+        # error must not reach the caller halfway through a transfer or airdrop
+        flush_wanted.set()
+
+
+def set_coins(user_id, amount):
+    change_coins(user_id, amount - balances[_slot(user_id)], "set_coins")
+
+
+def begin_ledger_batch():
+    # The write-ahead log is already flushed in batches
+    pass
+
+
+def flush_ledger():
+    pass
+
+
+def get_top_users(limit=10):
+    top = heapq.nlargest(limit, range(len(balances)), key=balances.__getitem__)
+    return [(records[slot].user_id, balances[slot]) for slot in top]
+
+
+def find_user_id_by_username(username):
+    return usernames.get(username.lower())
+
+
+def mute_user(user_id: int, hours: int = 4):
+    records[_slot(user_id)].muted_until = datetime.now(timezone.utc) + timedelta(hours=hours)
+    dirty_users.add(user_id)
+
+
+def is_user_muted(user_id):
+    slot = slots.get(user_id)
+    if slot is None or records[slot].muted_until is None:
+        return False
+    return records[slot].muted_until > datetime.now(timezone.utc)
+
+
+def is_user_bankrupt(user_id: int) -> bool:
+    slot = slots.get(user_id)
+    return slot is not None and balances[slot] <= 0
+
+
+def consume_cooldown(user_id: int, action: str, day: int) -> bool:
+    day_column, _ = database.COOLDOWN_COLUMNS[action]
+    record = records[_slot(user_id)]
+    if getattr(record, day_column) == day:
+        return False
+    setattr(record, day_column, day)
+    dirty_users.add(user_id)
+    return True
+
+
+def get_cooldown_days(user_id: int) -> dict:
+    slot = slots.get(user_id)
+    if slot is None:
+        return {}
+    record = records[slot]
+    return {action: getattr(record, day_column) for action, (day_column, _) in database.COOLDOWN_COLUMNS.items()}
+
+
+def get_gamble_bank(stale_ok: bool = False):
+    return gamble_bank
+
+
+def add_to_gamble_bank(amount: int):
+    global gamble_bank, bank_dirty
+    gamble_bank += amount
+    bank_dirty = True
+
+
+def reset_gamble_bank():
+    global gamble_bank, bank_dirty
+    gamble_bank = 0
+    bank_dirty = True
+
+
+def get_send_streak(from_user_id: int, to_user_id: int) -> int:
+    streak = streaks.get((from_user_id, to_user_id))
+    return streak.streak_count if streak else 0
+
+
+def update_send_streak(from_user_id: int, to_user_id: int):
+    today = datetime.now(timezone.utc).date()
+    key = (from_user_id, to_user_id)
+    streak = streaks.get(key)
+    if streak is None:
+        streaks[key] = Streak(from_user_id, to_user_id, 1, today)
+    elif streak.last_send_date == today:
+        return
+    elif streak.last_send_date == today - timedelta(days=1):
+        streak.streak_count += 1
+        streak.last_send_date = today
+    else:
+        streak.streak_count = 1
+        streak.last_send_date = today
+    dirty_streaks.add(key)
+
+
+def reset_send_streak(from_user_id: int, to_user_id: int):
+    key = (from_user_id, to_user_id)
+    if streaks.pop(key, None):
+        dirty_streaks.add(key)
+
+
+# === BULK OPERATIONS ===
+
+def airdrop(amount: int, tx_type: str = "airdrop") -> int:
+    for record in records:
+        change_coins(record.user_id, amount, tx_type)
+    return len(records)
+
+
+def reset_economy(amount: int = 0) -> int:
+    changed = 0
+    for slot, record in enumerate(records):
+        delta = amount - balances[slot]
+        if delta:
+            change_coins(record.user_id, delta, "season_reset")
+            changed += 1
+    reset_gamble_bank()
+    return changed
+
+
+def export_table(name: str, file):
+    # Bring users.coins and the ledger up to date first
+    snapshot()
+    database.export_table(name, file)
+
+
+def import_table(name: str, file) -> tuple:
+    snapshot(final=True)
+    try:
+        counts = database.import_table(name, file)
+    except Exception:
+        # The engine keeps running: mark the economy as owned again so the
+        # handoff guards and crash replay apply
+        snapshot()
+        raise
+    # Imported balances already include the imported ledger
+    load()
+    return counts
+
+
+# === PERSISTENCE ===
+
+def flush():
+    """Write the log and all dirty state to Postgres in one transaction."""
+    global bank_dirty
+    if not (wal or dirty_users or dirty_streaks or bank_dirty):
+        return
+
+    user_rows = []
+    for user_id in dirty_users:
+        record = records[slots[user_id]]
+        user_rows.append((user_id, record.username, record.muted_until,
+                          record.claim_day, record.quest_day, record.gamble_day))
+    streak_rows = [(*key, streaks[key].streak_count, streaks[key].last_send_date) for key in dirty_streaks if key in streaks]
+    deleted_streaks = [key for key in dirty_streaks if key not in streaks]
+
+    cur = database.get_cursor()
+    cur.execute("BEGIN")
+    try:
+        if user_rows:
+            # New users start at 0 coins; their balance comes from the ledger until the next snapshot
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO users (user_id, username, is_muted_until, claim_day, quest_day, gamble_day)
+                VALUES %s
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username = EXCLUDED.username,
+                    is_muted_until = EXCLUDED.is_muted_until,
+                    claim_day = EXCLUDED.claim_day,
+                    quest_day = EXCLUDED.quest_day,
+                    gamble_day = EXCLUDED.gamble_day
+            """, user_rows, page_size=1000)
+        if wal:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO transactions (user_id, type, amount, timestamp, target_user_id)
+                VALUES %s
+            """, wal, page_size=1000)
+        if streak_rows:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO send_streaks (from_user_id, to_user_id, streak_count, last_send_date)
+                VALUES %s
+                ON CONFLICT (from_user_id, to_user_id) DO UPDATE SET
+                    streak_count = EXCLUDED.streak_count,
+                    last_send_date = EXCLUDED.last_send_date
+            """, streak_rows)
+        for from_user_id, to_user_id in deleted_streaks:
+            cur.execute("DELETE FROM send_streaks WHERE from_user_id = %s AND to_user_id = %s",
+                        (from_user_id, to_user_id))
+        if bank_dirty:
+            cur.execute("UPDATE gamble_bank SET bank = %s WHERE id = TRUE", (gamble_bank,))
+        cur.execute("COMMIT")
+    except Exception:
+        if not cur.connection.closed:
+            cur.execute("ROLLBACK")
+        raise
+
+    wal.clear()
+    dirty_users.clear()
+    dirty_streaks.clear()
+    bank_dirty = False
+
+
+def snapshot(final: bool = False):
+    """Flush, then store every balance in users.coins with the ledger position it includes."""
+    flush()
+    cur = database.get_cursor()
+    cur.execute("BEGIN")
+    try:
+        psycopg2.extras.execute_values(cur, """
+            UPDATE users SET coins = v.coins
+            FROM (VALUES %s) AS v (user_id, coins)
+            WHERE users.user_id = v.user_id
+        """, [(record.user_id, balance) for record, balance in zip(records, balances)],
+            template="(%s::BIGINT, %s::INTEGER)", page_size=1000)
+        cur.execute("""
+            INSERT INTO engine_snapshots (taken_at, last_transaction_id, final)
+            SELECT now(), COALESCE(MAX(id), 0), %s FROM transactions
+        """, (final,))
+        cur.execute("DELETE FROM engine_snapshots WHERE taken_at < now() - INTERVAL '7 days'")
+        cur.execute("COMMIT")
+    except Exception:
+        if not cur.connection.closed:
+            cur.execute("ROLLBACK")
+        raise
+    logger.info("Engine snapshot written for %s users", len(records))
+
+
+def acquire_lock():
+    global lock_connection
+    if lock_connection is not None and not lock_connection.closed:
+        return
+    conn = reconcile.connect()
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (ENGINE_LOCK_ID,))
+        acquired = cur.fetchone()[0]
+    if not acquired:
+        conn.close()
+        raise RuntimeError("Another economy engine is running against this database; stop it first")
+    lock_connection = conn
+
+
+def release_lock():
+    global lock_connection
+    if lock_connection is not None:
+        lock_connection.close()
+        lock_connection = None
+
+
+def load():
+    """Rebuild the in-memory state from the latest snapshot plus the ledger written after it."""
+    global gamble_bank, balances
+    acquire_lock()
+    started = time.perf_counter()
+    slots.clear()
+    records.clear()
+    balances = array("q")
+    usernames.clear()
+    streaks.clear()
+
+    cur = database.get_cursor()
+    cur.execute("SELECT last_transaction_id, final FROM engine_snapshots ORDER BY id DESC LIMIT 1")
+    row = cur.fetchone()
+    # Only replay after a crash; otherwise users.coins is authoritative
+    mark = row[0] if row and not row[1] else None
+
+    cur.execute("""
+        SELECT user_id, username, coins, is_muted_until, claim_day, quest_day, gamble_day FROM users
+    """)
+    for user_id, username, coins, muted_until, claim_day, quest_day, gamble_day in cur.fetchall():
+        slots[user_id] = len(records)
+        records.append(UserRecord(user_id, username, muted_until, claim_day, quest_day, gamble_day))
+        balances.append(coins or 0)
+        if username:
+            usernames[username.lower()] = user_id
+
+    cur.execute("SELECT from_user_id, to_user_id, streak_count, last_send_date FROM send_streaks")
+    for row in cur.fetchall():
+        streaks[row[:2]] = Streak(*row)
+
+    gamble_bank = database.get_gamble_bank()
+    dirty_users.clear()
+
+    replayed = 0
+    if mark is None:
+        snapshot()
+    else:
+        conn = reconcile.connect()
+        try:
+            user_ids, sums = reconcile.ledger_sums(conn, min_id=mark)
+        finally:
+            conn.close()
+        for user_id, amount in zip(user_ids.tolist(), sums.tolist()):
+            balances[_slot(user_id)] += amount
+        replayed = len(user_ids)
+
+    logger.info("Engine loaded %s users (%s replayed from the ledger) in %.2fs",
+                len(records), replayed, time.perf_counter() - started)
+
+
+async def run():
+    """Flush the log every FLUSH_INTERVAL seconds (or as soon as it holds
+    FLUSH_BATCH_SIZE rows) and snapshot every SNAPSHOT_INTERVAL."""
+    last_snapshot = time.monotonic()
+    while True:
+        try:
+            await asyncio.wait_for(flush_wanted.wait(), FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        flush_wanted.clear()
+        try:
+            # Take the lock again if its connection dropped
+            acquire_lock()
+            if time.monotonic() - last_snapshot >= SNAPSHOT_INTERVAL:
+                snapshot()
+                last_snapshot = time.monotonic()
+            else:
+                flush()
+        except Exception:
+            # The log and dirty sets are kept and retried; back off so a full
+            # log doesn't turn a database outage into a busy loop
+            logger.exception("Failed to persist engine state")
+            await asyncio.sleep(FLUSH_INTERVAL)
+
+
+def recover():
+    """Replay the ledger after a crash and hand users.coins back to other writers.
+
+    Fails (without writing anything) while another engine holds the lock.
+    """
+    load()
+    close()
+
+
+def close():
+    snapshot(final=True)
+    release_lock()
@@ -0,0 +1,111 @@
+"""Non-blocking JSON logging.
+
+Handlers on the event loop only put records on a queue; a QueueListener
+thread formats them as JSON lines and writes them to stdout. Messages use
+lazy %-style arguments so formatting happens on the listener thread too.
+
+Records can carry an `event` name (pass extra={"event": ...}); high-volume
+events are sampled before they are queued (LOG_SAMPLE_RATES). Every record
+logged while an update is being handled gets its update_id.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+# Fraction of records kept per event name
+DEFAULT_SAMPLE_RATES = {
+    "sticker_penalty": 0.1,
+}
+
+current_update_id = contextvars.ContextVar("update_id", default=None)
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def parse_sample_rates(spec: str) -> dict:
+    """Parse overrides like "sticker_penalty=0.1,daily_claim=0.5"."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        event, rate = item.split("=")
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextFilter(logging.Filter):
+    """Stamp records with the update being handled and drop sampled-out events."""
+
+    def __init__(self, sample_rates: dict):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        event = getattr(record, "event", None)
+        rate = self.sample_rates.get(event)
+        if rate is not None:
+            if random.random() >= rate:
+                return False
+            record.sample_rate = rate
+        record.update_id = current_update_id.get()
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The default prepare() formats the message here, on the event loop;
+        # leave that to the listener thread
+        return record
+
+
+def setup_logging(level=None):
+    level = level or os.getenv("LOG_LEVEL", "INFO")
+    sample_rates = dict(DEFAULT_SAMPLE_RATES)
+    sample_rates.update(parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", "")))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter(sample_rates))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+async def update_context_middleware(handler, event, data):
+    """Outer update middleware that tags every log line with the update_id."""
+    token = current_update_id.set(event.update_id)
+    try:
+        return await handler(event, data)
+    finally:
+        current_update_id.reset(token)
@@ -1,14 +1,19 @@
 import os
 import logging # NEW: Import logging module
-import sys # NEW: Import sys for logging
 import random
+import asyncio
+import io
+import signal
+import tempfile
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.enums import ContentType
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, FSInputFile
 from aiogram.utils.markdown import hbold
-from datetime import datetime, timezone
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from datetime import datetime
 from dotenv import load_dotenv
 from roasts import ROASTS, BIG_SPENDER_ROASTS
 from quests import MAIN_QUESTS
@@ -22,11 +27,30 @@ load_dotenv()
 
 # Assuming your database.py handles external, persistent storage
 import database
+import cooldowns
+from throttling import ThrottlingMiddleware
+from logging_setup import setup_logging, update_context_middleware
+import profiling
 
 # --- CONFIGURATION (Environment Variables) ---
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 SECRET_TOKEN = os.getenv("SECRET_TOKEN")
 GROUP_ID = int(os.getenv("GROUP_ID"))  # Ensure this is an integer
+# Comma-separated Telegram user ids allowed to run admin commands
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+
+# Where the economy lives: "database" (default, Postgres on every call) or
+# "memory" (in-process engine backed by a write-ahead log, see engine.py)
+ECONOMY_ENGINE = os.getenv("ECONOMY_ENGINE", "database")
+
+# How updates are received: "webhook" (default, for Render) or "polling"
+BOT_MODE = os.getenv("BOT_MODE", "webhook")
+
+# Long polling configuration
+POLLING_BATCH_SIZE = int(os.getenv("POLLING_BATCH_SIZE", 100))  # Telegram caps getUpdates at 100
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", 30))
+# Point the bot at another Bot API server, e.g. a local fake one for benchmarks
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 
 # Webhook configuration for Render
 WEB_SERVER_HOST = "0.0.0.0"  # Listen on all available interfaces
@@ -39,42 +63,86 @@ WEB_SERVER_PORT = int(os.getenv("PORT", 8080))
 WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}"
 
 # Build the full webhook URL. RENDER_EXTERNAL_URL is provided by Render.
-WEBHOOK_URL = os.getenv("RENDER_EXTERNAL_URL") + WEBHOOK_PATH
+# Polling mode needs no public URL, so it's only required for webhooks
+WEBHOOK_URL = None
+if BOT_MODE != "polling":
+    RENDER_EXTERNAL_URL = os.getenv("RENDER_EXTERNAL_URL")
+    if not RENDER_EXTERNAL_URL:
+        raise RuntimeError("RENDER_EXTERNAL_URL is not set (required unless BOT_MODE=polling)")
+    WEBHOOK_URL = RENDER_EXTERNAL_URL + WEBHOOK_PATH
 
 # --- Logging Setup ---
-# Configure logging to output to stdout, which Render captures
-logging.basicConfig(level=logging.INFO, stream=sys.stdout,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+# JSON lines on stdout, which Render captures. Handlers only enqueue records;
+# a background thread formats and writes them (see logging_setup.py)
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# --- Economy Backend ---
+if ECONOMY_ENGINE == "memory":
+    import engine as economy
+    economy.load()
+else:
+    economy = database
+    # After an engine crash users.coins is missing ledger rows; writing on top
+    # of it would make the next engine start count them twice
+    if database.engine_owns_balances():
+        raise RuntimeError("The in-memory engine is running or didn't shut down cleanly. Stop it, "
+                           "or run `python economy_cli.py recover`, before using ECONOMY_ENGINE=database")
+cooldowns.store = economy
+
 # --- Bot and Dispatcher Initialization ---
 # Initialize bot outside the function for "warm" instances
-bot = Bot(BOT_TOKEN)
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(BOT_TOKEN, session=session)
 dp = Dispatcher()
 
+# Tag every log line with the update being handled
+dp.update.outer_middleware(update_context_middleware)
+# Log updates slower than SLOW_UPDATE_SECONDS with their stack and queries
+dp.update.outer_middleware(profiling.slow_update_middleware)
+
+# Shed spam before it reaches the handlers (limits can be tuned with THROTTLE_LIMITS)
+throttling = ThrottlingMiddleware(chat_id=GROUP_ID)
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+
 # --- Your Existing Bot Logic (Handlers) ---
 def get_daily_amount(coins):
     return 10 + (coins // 100) * 5
 
+# Keep references to fire-and-forget tasks so they aren't garbage collected
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def delete_later(message: types.Message, delay: int):
+    await asyncio.sleep(delay)
+    try:
+        await message.delete()
+    except Exception as e:
+        logger.warning("Could not delete daily claim message: %s", e)
+
 @dp.message(Command("quest"), F.chat.id == GROUP_ID)
 async def handle_quest_command(message: types.Message):
     user_id = message.from_user.id
     username = message.from_user.username
 
     # Only bankrupt users can go on quests
-    user = database.get_user(user_id)
-    if user["coins"] > 0:
+    user = economy.get_user(user_id)
+    if user and user.coins > 0:
         await message.reply("You're not broke enough to beg Tom Nook for a quest. Go spend more.")
         return
 
     # Can only go on a quest once per day
-    if database.has_used_quest_today(user_id):
+    if not cooldowns.check_and_consume(user_id, cooldowns.QUEST):
         await message.reply("You’ve already embarrassed yourself enough today. Come back tomorrow.")
         return
 
     # Pick a quest
     quest = random.choice(MAIN_QUESTS)
-    database.update_user_quest_time(user_id)
 
     # Build inline keyboard
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -130,9 +198,10 @@ async def handle_quest_choice(callback: types.CallbackQuery):
 
     # Apply reward
     if reward_type == "coins":
-        database.update_coins(original_user_id, 10)
+        economy.change_coins(original_user_id, 10, "quest_reward")
     elif reward_type == "mute":
-        database.mute_user(original_user_id, 4)
+        economy.mute_user(original_user_id, 4)
+        throttling.note_muted(original_user_id, True)
 
 @dp.message(Command("request"), F.chat.id == GROUP_ID)
 async def request_coins(message: types.Message):
@@ -156,14 +225,14 @@ async def request_coins(message: types.Message):
         return
 
     # Find target user
-    target_user_id = database.find_user_id_by_username(target_username)
+    target_user_id = economy.find_user_id_by_username(target_username)
 
     if not target_user_id:
         await message.reply("User not found or not an admin in the group.")
         return
 
     request_id = f"{requester_id}-{target_user_id}-{amount}-{datetime.now().timestamp()}"
-    database.add_pending_request(request_id, requester_id, target_user_id, requester_username, target_username, amount)
+    economy.add_pending_request(request_id, requester_id, target_user_id, requester_username, target_username, amount)
 
     # Buttons
     kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -182,45 +251,45 @@ async def request_coins(message: types.Message):
 @dp.callback_query(F.data.startswith("confirm:") | F.data.startswith("deny:"))
 async def handle_request_response(callback: CallbackQuery):
     action, request_id = callback.data.split(":")
-    req = database.get_pending_request(request_id)
-    logger.info(f"User {callback.from_user.username} tried to respond to /request: {callback.data}") # Added log
+    req = economy.get_pending_request(request_id)
+    logger.info("User %s tried to respond to /request: %s", callback.from_user.username, callback.data,
+                extra={"event": "request_response", "user_id": callback.from_user.id}) # Added log
     if not req:
         await callback.answer("This request no longer exists.", show_alert=True)
         return
 
-    from_id, to_id, from_username, to_username, amount = req
-
-    if callback.from_user.id != to_id:
+    if callback.from_user.id != req.to_id:
         await callback.answer("You're not allowed to respond to this request.", show_alert=True)
         return
 
     if action == "confirm":
-        database.add_user(from_id)
-        database.add_user(to_id)
+        economy.add_user(req.from_id)
+        economy.add_user(req.to_id)
 
-        user = database.get_user(to_id)
-        if user["to_balance"] < amount:
+        payer = economy.get_user(req.to_id)
+        if not payer or payer.coins < req.amount:
             await callback.message.edit_text("❌ Not enough coins to fulfill the request.")
         else:
-            database.update_coins(to_id, -amount)
-            database.update_coins(from_id, amount)
+            economy.change_coins(req.to_id, -req.amount, "request_paid", req.from_id)
+            economy.change_coins(req.from_id, req.amount, "request_received", req.to_id)
             await callback.message.edit_text(
-                f"✅ Request confirmed!\n{amount} coins sent from @{to_username} to @{from_username}"
+                f"✅ Request confirmed!\n{req.amount} coins sent from @{req.to_username} to @{req.from_username}"
             )
     else:
         await callback.message.edit_text(
-            f"❌ Request denied by @{to_username}"
+            f"❌ Request denied by @{req.to_username}"
         )
 
-    database.delete_pending_request(request_id)
+    economy.delete_pending_request(request_id)
     await callback.answer()
 
 @dp.message(Command("balance"), F.chat.id == GROUP_ID)
 async def balance(message: types.Message):
     user_id = message.from_user.id
-    user = database.get_user(user_id)
-    logger.info(f"User {user_id} requested balance: {user["coins"]}") # Added log
-    await message.reply(f"💰 Your balance: {user["coins"]} coins")
+    user = economy.get_user(user_id)
+    coins = user.coins if user else 0
+    logger.info("User %s requested balance: %s", user_id, coins, extra={"event": "balance", "user_id": user_id}) # Added log
+    await message.reply(f"💰 Your balance: {coins} coins")
 
 @dp.message(Command("send"), F.chat.id == GROUP_ID)
 async def send_coins(message: types.Message):
@@ -243,31 +312,27 @@ async def send_coins(message: types.Message):
         await message.reply("Amount must be positive.")
         return
     
-    to_user_id = database.find_user_id_by_username(to_username)
+    to_user_id = economy.find_user_id_by_username(to_username)
     if not to_user_id:
         await message.reply(f"User @{to_username} not found.")
         return
     
-    from_user = database.get_user(from_user_id)
-    if not from_user or from_user["coins"] < amount:
+    from_user = economy.get_user(from_user_id)
+    if not from_user or from_user.coins < amount:
         await message.reply("❌ Not enough coins.")
         return
     
     # Get streak bonus
-    streak = database.get_send_streak(from_user_id, to_user_id)
+    streak = economy.get_send_streak(from_user_id, to_user_id)
     streak_bonus = streak  # Bonus equals the current streak
     total_sent = amount + streak_bonus
     
-    # Update coins
-    database.update_coins(from_user_id, -amount)
-    database.update_coins(to_user_id, total_sent)
-    
-    # Log transaction
-    database.log_transaction(from_user_id, "send", -amount, to_user_id)
-    database.log_transaction(to_user_id, "receive", total_sent, from_user_id)
+    # Update coins and log transactions
+    economy.change_coins(from_user_id, -amount, "send", to_user_id)
+    economy.change_coins(to_user_id, total_sent, "receive", from_user_id)
     
     # Update streak
-    database.update_send_streak(from_user_id, to_user_id)
+    economy.update_send_streak(from_user_id, to_user_id)
     
     # Build response message
     streak_text = f"\n🔥 <b>Streak Bonus:</b> +{streak_bonus} coins (Day {streak + 1})" if streak_bonus > 0 else ""
@@ -284,13 +349,13 @@ user_bets = {}
 
 @dp.message(Command("gamble"))
 async def gamble_command(message: types.Message):
-    gamble_bank = database.get_gamble_bank()
+    gamble_bank = economy.get_gamble_bank(stale_ok=True)
 
     user_id = message.from_user.id
-    user = database.get_user(user_id)
+    user = economy.get_user(user_id)
 
     # Check if user has gambled today
-    if database.has_used_gamble_today(user_id):
+    if cooldowns.is_used(user_id, cooldowns.GAMBLE):
         await message.reply("❌ You have already gambled today. Try again tomorrow!")
         return
 
@@ -301,7 +366,7 @@ async def gamble_command(message: types.Message):
 
     bet = int(args[1])
 
-    if not user or user["coins"] < bet:
+    if not user or user.coins < bet:
         await message.reply("❌ Not enough coins to gamble.")
         return
 
@@ -328,16 +393,21 @@ async def gamble_command(message: types.Message):
 
 @dp.callback_query(F.data.startswith("gamble:"))
 async def handle_gamble_choice(callback: types.CallbackQuery):
-    gamble_bank = database.get_gamble_bank()
+    gamble_bank = economy.get_gamble_bank()
     user_id = callback.from_user.id
 
     if user_id not in user_bets:
         await callback.answer("❌ You don’t have an active gamble.", show_alert=True)
         return
 
-    bet = user_bets[user_id]
+    bet = user_bets.pop(user_id)
     choice = int(callback.data.split(":")[1])
 
+    # Mark user as having gambled today
+    if not cooldowns.check_and_consume(user_id, cooldowns.GAMBLE):
+        await callback.answer("❌ You have already gambled today. Try again tomorrow!", show_alert=True)
+        return
+
     # Roll dice
     dice_message = await callback.message.answer("🎲 Rolling the dice...")
     dice = await callback.message.answer_dice(emoji="🎲")
@@ -345,19 +415,17 @@ async def handle_gamble_choice(callback: types.CallbackQuery):
 
     if result == choice:
         winnings = bet + gamble_bank
-        database.update_coins(user_id, winnings)
-        database.log_transaction(user_id, "gamble_win", winnings)
+        economy.change_coins(user_id, winnings, "gamble_win")
         await dice_message.edit_text(
             f"✅ Dice rolled {result} — You guessed right!\n"
             f"🎯 Your choice: {choice}\n"
             f"🏆 Jackpot won: {gamble_bank} coins!\n"
             f"💰 You gain {winnings} coins"
         )
-        database.reset_gamble_bank()
+        economy.reset_gamble_bank()
     else:
-        database.update_coins(user_id, -bet)
-        database.log_transaction(user_id, "gamble_loss", -bet)
-        database.add_to_gamble_bank(bet)
+        economy.change_coins(user_id, -bet, "gamble_loss")
+        economy.add_to_gamble_bank(bet)
         await dice_message.edit_text(
             f"❌ Dice rolled {result} — You lost your bet!\n"
             f"🎯 Your choice: {choice}\n"
@@ -365,91 +433,149 @@ async def handle_gamble_choice(callback: types.CallbackQuery):
             f"💰 Bank is now {gamble_bank + bet} coins"
         )
 
-    # Mark user as having gambled today
-    database.update_user_gamble_time(user_id)
-
-    del user_bets[user_id]
     await callback.answer()
 
 @dp.message(Command("leaderboard"), F.chat.id == GROUP_ID)
 async def leaderboard(message: types.Message):
-    top_users = database.get_top_users(limit=10)
+    top_users = economy.get_top_users(limit=10)
     if not top_users:
         await message.reply("No one has any coins yet. Get chatting to earn some!")
         return
 
     text = "🏆 " + hbold("Tom Nook's Leaderboard") + " 🏆\n\n"
-    for idx, user in enumerate(top_users, 1):
+    for idx, (user_id, coins) in enumerate(top_users, 1):
         try:
-            member = await bot.get_chat_member(GROUP_ID, user["user_id"])
+            member = await bot.get_chat_member(GROUP_ID, user_id)
             name = member.user.first_name
             if member.user.username:
                 name = f"{member.user.username}"
         except Exception:
-            name = f"[unknown user {user["user_id"]}]"
-        text += f"{idx}. {name} — {user["coins"]} coins\n"
-    logger.info("Leaderboard requested and sent.") # Added log
+            name = f"[unknown user {user_id}]"
+        text += f"{idx}. {name} — {coins} coins\n"
+    logger.info("Leaderboard requested and sent.", extra={"event": "leaderboard"}) # Added log
     await message.reply(text, parse_mode="HTML")
 
+# --- Admin Commands ---
+@dp.message(Command("airdrop"), F.from_user.id.in_(ADMIN_IDS))
+async def airdrop_command(message: types.Message):
+    args = message.text.split()
+    if len(args) != 2 or not args[1].isdigit():
+        await message.reply("Usage: /airdrop <amount>")
+        return
+
+    amount = int(args[1])
+    count = economy.airdrop(amount)
+    logger.info("Admin %s airdropped %s coins to %s users", message.from_user.id, amount, count,
+                extra={"event": "airdrop", "user_id": message.from_user.id})
+    await message.reply(f"🪂 Airdropped {amount} coins to {count} users!")
+
+@dp.message(Command("reset_season"), F.from_user.id.in_(ADMIN_IDS))
+async def reset_season_command(message: types.Message):
+    args = message.text.split()
+    if len(args) > 2 or (len(args) == 2 and not args[1].isdigit()):
+        await message.reply("Usage: /reset_season [starting_balance]")
+        return
+
+    amount = int(args[1]) if len(args) == 2 else 0
+    count = economy.reset_economy(amount)
+    logger.info("Admin %s reset the season to %s coins (%s balances changed)", message.from_user.id, amount, count,
+                extra={"event": "season_reset", "user_id": message.from_user.id})
+    await message.reply(f"🍂 New season! Every balance is now {amount} coins ({count} users changed).")
+
+@dp.message(Command("export"), F.from_user.id.in_(ADMIN_IDS))
+async def export_command(message: types.Message):
+    args = message.text.split()
+    if len(args) != 2 or args[1] not in database.BULK_TABLES:
+        await message.reply(f"Usage: /export <{'|'.join(database.BULK_TABLES)}>")
+        return
+
+    table = args[1]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, f"{table}.csv")
+        with open(path, "wb") as file:
+            economy.export_table(table, file)
+        await message.reply_document(FSInputFile(path))
+
+@dp.message(Command("import"), F.document, F.from_user.id.in_(ADMIN_IDS))
+async def import_command(message: types.Message):
+    args = message.caption.split()
+    if len(args) != 2 or args[1] not in database.BULK_TABLES:
+        await message.reply(f"Usage: send a CSV from /export with the caption /import <{'|'.join(database.BULK_TABLES)}>")
+        return
+
+    file = io.BytesIO()
+    await bot.download(message.document, destination=file)
+    file.seek(0)
+    try:
+        imported, skipped = economy.import_table(args[1], file)
+    except Exception as e:
+        logger.error("Import of %s failed: %s", args[1], e)
+        await message.reply(f"❌ Import failed: {e}")
+        return
+    logger.info("Admin %s imported %s %s rows (%s skipped)", message.from_user.id, imported, args[1], skipped,
+                extra={"event": "import", "user_id": message.from_user.id})
+    await message.reply(f"✅ Imported {imported} {args[1]} rows ({skipped} skipped).")
+
 @dp.message(F.chat.id == GROUP_ID)
 async def handle_messages(message: types.Message):
     user_id = message.from_user.id
     username = message.from_user.username
-    database.add_user(user_id, username=username)
+    economy.add_user(user_id, username=username)
 
     # 💬 If user is muted, delete message
-    if database.is_user_muted(user_id):
+    muted = economy.is_user_muted(user_id)
+    # Lets the throttler delete (rather than drop) over-limit messages from muted and broke users
+    throttling.note_muted(user_id, muted)
+    if muted:
         await message.delete()
-        logger.info(f"Deleted message from muted user {user_id}.")
+        logger.info("Deleted message from muted user %s.", user_id, extra={"event": "muted_message_deleted", "user_id": user_id})
         return
 
-    user = database.get_user(user_id)
-    today_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    user = economy.get_user(user_id)
+    coins = user.coins if user else 0
+    throttling.note_balance(user_id, coins)
 
     # 🎁 Daily claim
-    if user["last_claim"] != today_str:
-        daily_amount = get_daily_amount(user["coins"])
-        database.update_coins(user_id, daily_amount)
-        database.set_last_claim(user_id, today_str)
-        database.log_transaction(user_id, "daily_claim", daily_amount)
-        logger.info(f"User {user_id} claimed daily coins: +{daily_amount}")
+    if cooldowns.check_and_consume(user_id, cooldowns.CLAIM):
+        daily_amount = get_daily_amount(coins)
+        economy.change_coins(user_id, daily_amount, "daily_claim")
+        throttling.note_balance(user_id, coins + daily_amount)
+        logger.info("User %s claimed daily coins: +%s", user_id, daily_amount, extra={"event": "daily_claim", "user_id": user_id})
 
         # Send a temporary reply
         claim_msg = await message.reply(
-            f"✅ Daily claim: +{daily_amount} coins! Your balance: {user['coins'] + daily_amount}"
+            f"✅ Daily claim: +{daily_amount} coins! Your balance: {coins + daily_amount}"
         )
-        await asyncio.sleep(60)  # wait 1 minute
-        try:
-            await claim_msg.delete()
-        except Exception as e:
-            logger.warning(f"Could not delete daily claim message: {e}")
+        # Delete it after 1 minute without holding up this update
+        run_in_background(delete_later(claim_msg, 60))
 
     # 🚫 Block media if coins <= 0
-    if user["coins"] <= 0 and message.content_type in [
+    if coins <= 0 and message.content_type in [
         ContentType.STICKER, ContentType.PHOTO, ContentType.VIDEO, ContentType.ANIMATION
     ]:
         await message.delete()
-        logger.info(f"Deleted content from user {user_id} due to 0 coins.")
+        logger.info("Deleted content from user %s due to 0 coins.", user_id, extra={"event": "media_deleted", "user_id": user_id})
         return
 
     # 🐱 Sticker penalty
     if message.content_type == ContentType.STICKER:
-        if user["coins"] > 0:
-            database.update_coins(user_id, -1)
-            database.log_transaction(user_id, "sticker_penalty", -1)
-            logger.info(f"User {user_id} sent sticker, -1 coin. Balance: {user['coins'] - 1}")
+        if coins > 0:
+            economy.change_coins(user_id, -1, "sticker_penalty")
+            throttling.note_balance(user_id, coins - 1)
+            logger.info("User %s sent sticker, -1 coin. Balance: %s", user_id, coins - 1,
+                        extra={"event": "sticker_penalty", "user_id": user_id})
         else:
             await message.delete()
-            logger.info(f"Deleted sticker from user {user_id} due to 0 coins.")
+            logger.info("Deleted sticker from user %s due to 0 coins.", user_id, extra={"event": "sticker_deleted", "user_id": user_id})
 
 # --- NEW: Webhook Setup for Render ---
 async def on_startup(dispatcher: Dispatcher, bot: Bot):
     try:
         await bot.delete_webhook(drop_pending_updates=True)
         await bot.set_webhook(WEBHOOK_URL, secret_token=SECRET_TOKEN, request_timeout=90, allowed_updates=["message", "callback_query"])
-        logger.info(f"Webhook set to: {WEBHOOK_URL}")
+        logger.info("Webhook set to: %s", WEBHOOK_URL)
     except Exception as e:
-        logger.error(f"Failed to set webhook: {e}")
+        logger.error("Failed to set webhook: %s", e)
 
 async def on_shutdown(dispatcher: Dispatcher, bot: Bot):
     """
@@ -460,28 +586,124 @@ async def on_shutdown(dispatcher: Dispatcher, bot: Bot):
         await bot.delete_webhook()
         logger.info("Webhook deleted.") # Changed print to logger.info
     except Exception as e:
-        logger.error(f"Failed to delete webhook: {e}") # Log any errors
+        logger.error("Failed to delete webhook: %s", e) # Log any errors
 
     # Close database connections if your database.py has a global connection pool
     # Or ensure connections are closed per request.
 
-import asyncio
+# --- Economy Engine Lifecycle ---
+def start_economy():
+    # The in-memory engine persists its write-ahead log in the background
+    if economy is not database:
+        run_in_background(economy.run())
+
+def cancel_on_sigterm():
+    """Render stops and redeploys the service with SIGTERM. Cancel the main task
+    instead of dying, so the finally blocks run and the engine takes its final snapshot."""
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+def stop_economy():
+    if economy is not database:
+        economy.close()
+
+# --- Long Polling Mode ---
+def ingest_batch(updates):
+    """Register every message sender in the batch with a single query."""
+    senders = {}
+    for update in updates:
+        message = update.message
+        if message and message.from_user and message.chat.id == GROUP_ID:
+            senders[message.from_user.id] = message.from_user.username
+    economy.add_users(senders.items())
+
+async def process_batch(updates):
+    try:
+        ingest_batch(updates)
+    except Exception:
+        # Only a shortcut: the handlers register their users as well
+        logger.exception("Failed to register the senders of %s updates", len(updates))
+    # Ledger rows written by the handlers go out as one insert at the end of the batch
+    economy.begin_ledger_batch()
+    try:
+        results = await asyncio.gather(
+            *(dp.feed_update(bot, update) for update in updates),
+            return_exceptions=True
+        )
+    finally:
+        economy.flush_ledger()
+
+    for update, result in zip(updates, results):
+        if isinstance(result, Exception):
+            logger.error("Failed to process update %s", update.update_id, exc_info=result)
+
+async def poll():
+    # getUpdates doesn't work while a webhook is set
+    await bot.delete_webhook()
+    logger.info("Polling for updates in batches of up to %s", POLLING_BATCH_SIZE)
+    cancel_on_sigterm()
+    start_economy()
+
+    # There is no webhook server in this mode; serve the profiling endpoint on its own
+    if profiling.PROFILE_TOKEN:
+        app = web.Application()
+        profiling.setup_routes(app)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT).start()
+        logger.info("Profiling endpoint on %s:%s/debug/profile", WEB_SERVER_HOST, WEB_SERVER_PORT)
+
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset,
+                limit=POLLING_BATCH_SIZE,
+                timeout=POLLING_TIMEOUT,
+                allowed_updates=["message", "callback_query"],
+                request_timeout=POLLING_TIMEOUT + 10
+            )
+        except Exception as e:
+            logger.error("Failed to fetch updates: %s", e)
+            await asyncio.sleep(5)
+            continue
+
+        if not updates:
+            continue
+        offset = updates[-1].update_id + 1
+        try:
+            await process_batch(updates)
+        except Exception:
+            # Unwritten ledger rows stay buffered and go out with the next batch
+            logger.exception("Failed to process a batch of %s updates", len(updates), extra={"event": "batch_failed"})
 
-if __name__ == "__main__":
+if __name__ == "__main__" and BOT_MODE == "polling":
+    logger.info("Bot application starting in polling mode...")
+    try:
+        asyncio.run(poll())
+    except asyncio.CancelledError:
+        logger.info("Received SIGTERM, shutting down")
+    finally:
+        stop_economy()
+
+elif __name__ == "__main__":
     logger.info("Bot application starting...")
 
     app = web.Application()
 
     # Register webhook handler
     SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=SECRET_TOKEN).register(app, path=WEBHOOK_PATH)
+    # On-demand profiling, enabled by setting PROFILE_TOKEN
+    profiling.setup_routes(app)
 
     async def start():
         # --- Explicitly call your startup logic here ---
         await on_startup(dp, bot)
+        cancel_on_sigterm()
+        start_economy()
 
         # Run the web server
-        logger.info(f"Starting web server on {WEB_SERVER_HOST}:{WEB_SERVER_PORT}")
-        logger.info(f"Expected webhook URL: {WEBHOOK_URL}")
+        logger.info("Starting web server on %s:%s", WEB_SERVER_HOST, WEB_SERVER_PORT)
+        logger.info("Expected webhook URL: %s", WEBHOOK_URL)
         runner = web.AppRunner(app)
         await runner.setup()
         site = web.TCPSite(runner, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
@@ -491,6 +713,11 @@ if __name__ == "__main__":
         while True:
             await asyncio.sleep(3600)
 
-    asyncio.run(start())
+    try:
+        asyncio.run(start())
+    except asyncio.CancelledError:
+        logger.info("Received SIGTERM, shutting down")
+    finally:
+        stop_economy()
 
 
@@ -0,0 +1,40 @@
+"""Rows returned by the economy backends (database.py and engine.py).
+
+Built from plain tuple cursors that select exactly these columns, in this
+order, so each row can be made with Model(*row). Lookups return None when
+nothing matches.
+"""
+
+
+class User:
+    __slots__ = ("user_id", "username", "coins", "is_muted_until")
+
+    def __init__(self, user_id, username, coins, is_muted_until):
+        self.user_id = user_id
+        self.username = username
+        self.coins = coins
+        self.is_muted_until = is_muted_until
+
+    def __repr__(self):
+        return f"User(user_id={self.user_id}, username={self.username!r}, coins={self.coins})"
+
+
+class PendingRequest:
+    __slots__ = ("from_id", "to_id", "from_username", "to_username", "amount")
+
+    def __init__(self, from_id, to_id, from_username, to_username, amount):
+        self.from_id = from_id
+        self.to_id = to_id
+        self.from_username = from_username
+        self.to_username = to_username
+        self.amount = amount
+
+
+class Streak:
+    __slots__ = ("from_user_id", "to_user_id", "streak_count", "last_send_date")
+
+    def __init__(self, from_user_id, to_user_id, streak_count, last_send_date):
+        self.from_user_id = from_user_id
+        self.to_user_id = to_user_id
+        self.streak_count = streak_count
+        self.last_send_date = last_send_date
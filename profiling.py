@@ -0,0 +1,136 @@
+"""On-demand profiling for the running bot.
+
+GET /debug/profile?seconds=10 (with an X-Profile-Token header matching
+PROFILE_TOKEN) runs cProfile over the event loop thread for the given
+window. During that window it also turns on asyncio debug mode so slow
+callbacks get reported. The response is a plain-text report.
+
+slow_update_middleware logs every update that takes longer than
+SLOW_UPDATE_SECONDS. The log includes the handler's stack at the moment it
+crossed the threshold and the queries it ran.
+"""
+import asyncio
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import time
+import traceback
+
+from aiohttp import web
+
+import database
+
+logger = logging.getLogger(__name__)
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+MAX_PROFILE_SECONDS = 120
+SLOW_CALLBACK_SECONDS = float(os.getenv("SLOW_CALLBACK_SECONDS", 0.1))
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", 1.0))
+
+profile_lock = asyncio.Lock()
+
+
+class _RecordCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+async def profile_handler(request: web.Request):
+    token = request.headers.get("X-Profile-Token", "")
+    if not PROFILE_TOKEN or not hmac.compare_digest(token, PROFILE_TOKEN):
+        raise web.HTTPForbidden()
+    if profile_lock.locked():
+        raise web.HTTPConflict(text="A profiling session is already running.")
+
+    try:
+        seconds = min(float(request.query.get("seconds", 10)), MAX_PROFILE_SECONDS)
+        limit = int(request.query.get("limit", 40))
+    except ValueError:
+        raise web.HTTPBadRequest(text="seconds and limit must be numbers.")
+    sort = request.query.get("sort", "cumulative")
+
+    async with profile_lock:
+        loop = asyncio.get_running_loop()
+        debug, slow_callback_duration = loop.get_debug(), loop.slow_callback_duration
+        slow_callbacks = _RecordCollector()
+        asyncio_logger = logging.getLogger("asyncio")
+        asyncio_logger.addHandler(slow_callbacks)
+        loop.set_debug(True)
+        loop.slow_callback_duration = SLOW_CALLBACK_SECONDS
+
+        logger.info("Profiling the event loop for %ss", seconds, extra={"event": "profile"})
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            loop.set_debug(debug)
+            loop.slow_callback_duration = slow_callback_duration
+            asyncio_logger.removeHandler(slow_callbacks)
+
+    report = io.StringIO()
+    report.write(f"Profiled the event loop for {seconds}s\n\n")
+    report.write(f"Callbacks slower than {SLOW_CALLBACK_SECONDS}s: {len(slow_callbacks.messages)}\n")
+    for message in slow_callbacks.messages:
+        report.write(f"  {message}\n")
+    report.write("\n")
+    try:
+        pstats.Stats(profiler, stream=report).sort_stats(sort).print_stats(limit)
+    except KeyError:
+        raise web.HTTPBadRequest(text=f"Unknown sort key: {sort}")
+    return web.Response(text=report.getvalue())
+
+
+def setup_routes(app: web.Application):
+    if PROFILE_TOKEN:
+        app.router.add_get("/debug/profile", profile_handler)
+
+
+def format_await_stack(coro):
+    """Format the chain of awaits a suspended coroutine is parked in, outermost first.
+
+    Task.get_stack() only reaches the task's own coroutine frame; the frame
+    that is actually slow is usually several awaits further down.
+    """
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append((frame, frame.f_lineno))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return "".join(traceback.StackSummary.extract(frames).format())
+
+
+async def slow_update_middleware(handler, event, data):
+    """Outer update middleware that logs updates slower than SLOW_UPDATE_SECONDS."""
+    queries = []
+    token = database.query_log.set(queries)
+    task = asyncio.current_task()
+    stack = []
+    # Grab the stack where the handler is when it crosses the threshold
+    timer = asyncio.get_running_loop().call_later(
+        SLOW_UPDATE_SECONDS, lambda: stack.append(format_await_stack(task.get_coro()))
+    )
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        timer.cancel()
+        database.query_log.reset(token)
+        elapsed = time.perf_counter() - started
+        if elapsed >= SLOW_UPDATE_SECONDS:
+            logger.warning("Update %s took %.3fs", event.update_id, elapsed, extra={
+                "event": "slow_update",
+                "duration": round(elapsed, 3),
+                "queries": queries,
+                "stack": stack[0] if stack else None,
+            })
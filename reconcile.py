@@ -0,0 +1,148 @@
+"""Ledger replay and balance reconciliation.
+
+Replays the `transactions` ledger and compares the per-user sums with the
+balances stored in `users.coins`. The ledger is streamed through a
+server-side cursor in chunks and aggregated with NumPy, so millions of
+rows never have to be held in Python objects at once.
+
+Usage:
+    python reconcile.py            # report drift
+    python reconcile.py --fix      # append adjustment rows for every drifting user
+
+Run --fix with the bot stopped. In database mode a balance change and its
+ledger row are separate statements (and polling mode batches ledger rows),
+so a live bot can show transient drift that must not be written back. With
+ECONOMY_ENGINE=memory users.coins lags the ledger until the engine's final
+snapshot, so --fix refuses to run until the engine has shut down cleanly.
+"""
+import argparse
+import time
+
+import numpy as np
+import psycopg2
+import psycopg2.extras
+
+import database
+
+CHUNK_SIZE = 100_000
+ADJUSTMENT_TYPE = "reconcile_adjustment"
+
+
+def connect():
+    # Named (server-side) cursors only live inside a transaction, so the
+    # replay uses its own connection instead of the autocommit one in database.py
+    return psycopg2.connect(
+        user=database.DB_USER,
+        password=database.DB_PASSWORD,
+        host=database.DB_HOST,
+        port=database.DB_PORT,
+        dbname=database.DB_NAME
+    )
+
+
+def _group_sum(user_ids, amounts):
+    ids, inverse = np.unique(user_ids, return_inverse=True)
+    # Integer accumulation: bincount's float64 weights lose precision above 2**53
+    sums = np.zeros(len(ids), dtype=np.int64)
+    np.add.at(sums, inverse, amounts)
+    return ids, sums
+
+
+def ledger_sums(conn, min_id: int = 0, chunk_size: int = CHUNK_SIZE):
+    """Return sorted (user_ids, sums) arrays for ledger rows with id > min_id."""
+    partial_ids, partial_sums = [], []
+    with conn.cursor(name="ledger_replay") as cur:
+        cur.itersize = chunk_size
+        cur.execute("""
+            SELECT user_id, COALESCE(amount, 0) FROM transactions
+            WHERE id > %s AND user_id IS NOT NULL
+        """, (min_id,))
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk = np.array(rows, dtype=np.int64)
+            ids, sums = _group_sum(chunk[:, 0], chunk[:, 1])
+            partial_ids.append(ids)
+            partial_sums.append(sums)
+
+    if not partial_ids:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return _group_sum(np.concatenate(partial_ids), np.concatenate(partial_sums))
+
+
+def user_balances(conn):
+    """Return sorted (user_ids, coins) arrays for every user."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT user_id, COALESCE(coins, 0) FROM users ORDER BY user_id")
+        rows = cur.fetchall()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    table = np.array(rows, dtype=np.int64)
+    return table[:, 0], table[:, 1]
+
+
+def find_drift(conn):
+    """Return (user_ids, coins, ledger, drift) arrays for users whose balance differs from the ledger.
+
+    Ledger rows for users that no longer exist show up with a balance of 0.
+    Must be called outside a transaction; the caller ends the one it opens.
+    """
+    # Both reads must see the same snapshot, or a balance change committed
+    # between them would show up as drift
+    with conn.cursor() as cur:
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+    ledger_ids, ledger = ledger_sums(conn)
+    user_ids, coins = user_balances(conn)
+
+    all_ids = np.union1d(user_ids, ledger_ids)
+    all_coins = np.zeros(len(all_ids), dtype=np.int64)
+    all_ledger = np.zeros(len(all_ids), dtype=np.int64)
+    all_coins[np.searchsorted(all_ids, user_ids)] = coins
+    all_ledger[np.searchsorted(all_ids, ledger_ids)] = ledger
+
+    drift = all_coins - all_ledger
+    mask = drift != 0
+    return all_ids[mask], all_coins[mask], all_ledger[mask], drift[mask]
+
+
+def write_adjustments(conn, user_ids, drift):
+    """Append one adjustment row per user so the ledger sums match users.coins."""
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO transactions (user_id, type, amount, timestamp, target_user_id)
+            VALUES %s
+        """, [(int(u), ADJUSTMENT_TYPE, int(d)) for u, d in zip(user_ids, drift)],
+            template="(%s, %s, %s, now(), NULL)")
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile users.coins against the transactions ledger.")
+    parser.add_argument("--fix", action="store_true", help="append adjustment rows for every drifting user")
+    parser.add_argument("--limit", type=int, default=50, help="max drifting users to print")
+    args = parser.parse_args()
+
+    conn = connect()
+    try:
+        started = time.perf_counter()
+        user_ids, coins, ledger, drift = find_drift(conn)
+        elapsed = time.perf_counter() - started
+        conn.rollback()
+
+        print(f"Replayed ledger in {elapsed:.2f}s — {len(user_ids)} user(s) drifting, total drift {int(drift.sum())} coins")
+        for row in list(zip(user_ids, coins, ledger, drift))[:args.limit]:
+            print("user {} balance={} ledger={} drift={:+d}".format(*(int(v) for v in row)))
+
+        if args.fix and len(user_ids) and database.engine_owns_balances():
+            raise SystemExit("❌ The in-memory engine is running or didn't shut down cleanly, so users.coins "
+                             "is behind the ledger. Stop it (or start and stop it once to recover) before --fix.")
+        if args.fix and len(user_ids):
+            write_adjustments(conn, user_ids, drift)
+            print(f"✅ Wrote {len(user_ids)} {ADJUSTMENT_TYPE} row(s)")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
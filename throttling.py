@@ -0,0 +1,142 @@
+"""Per-user, per-action rate limiting for incoming updates.
+
+Excess updates are shed in an outer middleware, before any handler or
+database query runs. Each (user, action) pair is a token bucket stored as a
+single float, the time at which the bucket will be full again (the GCRA form
+of a token bucket). Full buckets carry no information, so idle ones are
+evicted by a periodic sweep.
+
+Rejected updates are dropped and stay in the chat. The exception is
+moderation: muted users' messages and broke users' media are deleted by
+the message handler, so dropping them would let them through. The handler
+reports who is muted or broke (note_muted/note_balance). Rejected messages
+from those users in the group chat are deleted, with no query on the
+rejection path.
+"""
+import os
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.enums import ContentType
+from aiogram.types import CallbackQuery, Message
+
+# Content the message handler deletes when the sender has no coins
+BROKE_BLOCKED_TYPES = {ContentType.STICKER, ContentType.PHOTO, ContentType.VIDEO, ContentType.ANIMATION}
+
+# action -> (burst size, seconds to earn back one token)
+DEFAULT_LIMITS = {
+    "send": (3, 20.0),
+    "request": (3, 20.0),
+    "gamble": (3, 10.0),
+    "quest": (3, 10.0),
+    "sticker": (5, 6.0),
+    "callback": (5, 1.0),
+    "message": (20, 0.5),
+}
+
+SWEEP_INTERVAL = 60.0
+
+
+def parse_limits(spec: str) -> dict:
+    """Parse overrides like "send=3/20,sticker=5/6" (burst/seconds per token)."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        action, rate = item.split("=")
+        burst, interval = rate.split("/")
+        limits[action.strip()] = (int(burst), float(interval))
+    return limits
+
+
+def load_limits() -> dict:
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(parse_limits(os.getenv("THROTTLE_LIMITS", "")))
+    return limits
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, limits: dict = None, chat_id: int = None):
+        self.limits = limits or load_limits()
+        self.chat_id = chat_id
+        # Users last seen muted / with no coins by the message handler
+        self.muted_users = set()
+        self.broke_users = set()
+        self.actions = {action: index for index, action in enumerate(self.limits)}
+        self.rules = [self.limits[action] for action in self.actions]
+        # (user_id * number of actions + action index) -> time the bucket is full again
+        self.full_at = {}
+        self.next_sweep = time.monotonic() + SWEEP_INTERVAL
+
+    def classify(self, event) -> str:
+        if isinstance(event, CallbackQuery):
+            return "callback"
+        if event.text and event.text.startswith("/"):
+            command = event.text.split()[0][1:].split("@")[0].lower()
+            if command in self.actions:
+                return command
+        if event.content_type == ContentType.STICKER:
+            return "sticker"
+        return "message"
+
+    def allow(self, user_id: int, action: str) -> bool:
+        index = self.actions.get(action)
+        if index is None:
+            return True
+
+        now = time.monotonic()
+        if now >= self.next_sweep:
+            self.sweep(now)
+
+        burst, interval = self.rules[index]
+        key = user_id * len(self.rules) + index
+        full_at = max(self.full_at.get(key, now), now) + interval
+        # Over the limit once the bucket would need more than `burst` tokens to refill
+        if full_at - now > burst * interval:
+            return False
+        self.full_at[key] = full_at
+        return True
+
+    def note_muted(self, user_id: int, muted: bool):
+        if muted:
+            self.muted_users.add(user_id)
+        else:
+            self.muted_users.discard(user_id)
+
+    def note_balance(self, user_id: int, coins: int):
+        if coins <= 0:
+            self.broke_users.add(user_id)
+        else:
+            self.broke_users.discard(user_id)
+
+    def would_be_deleted(self, message: Message) -> bool:
+        """Whether the message handler would delete this message anyway."""
+        # Commands go to their own handlers, which don't moderate
+        if message.text and message.text.startswith("/"):
+            return False
+        user_id = message.from_user.id
+        if user_id in self.muted_users:
+            return True
+        return user_id in self.broke_users and message.content_type in BROKE_BLOCKED_TYPES
+
+    def sweep(self, now: float):
+        for key in [key for key, full_at in self.full_at.items() if full_at <= now]:
+            del self.full_at[key]
+        self.next_sweep = now + SWEEP_INTERVAL
+
+    async def __call__(self, handler, event, data):
+        user = event.from_user
+        if user is None:
+            return await handler(event, data)
+
+        action = self.classify(event)
+        if self.allow(user.id, action):
+            return await handler(event, data)
+
+        # Rejections only talk to Telegram, never to the database
+        if isinstance(event, CallbackQuery):
+            await event.answer("🐢 Slow down!")
+        elif isinstance(event, Message) and event.chat.id == self.chat_id and self.would_be_deleted(event):
+            try:
+                await event.delete()
+            except Exception:
+                pass
+        return None